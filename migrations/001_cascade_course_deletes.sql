@@ -0,0 +1,36 @@
+-- Recreate every foreign key to courses.id with ON DELETE CASCADE (see db.py).
+-- create_all only applies this to new tables; run once on existing databases:
+--   psql "$DATABASE_URL" -f migrations/001_cascade_course_deletes.sql
+BEGIN;
+
+ALTER TABLE course_students
+    DROP CONSTRAINT IF EXISTS course_students_course_id_fkey,
+    ADD CONSTRAINT course_students_course_id_fkey
+        FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE;
+
+ALTER TABLE course_hashtags
+    DROP CONSTRAINT IF EXISTS course_hashtags_course_id_fkey,
+    ADD CONSTRAINT course_hashtags_course_id_fkey
+        FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE;
+
+ALTER TABLE course_favs
+    DROP CONSTRAINT IF EXISTS course_favs_course_id_fkey,
+    ADD CONSTRAINT course_favs_course_id_fkey
+        FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE;
+
+ALTER TABLE course_collaborators
+    DROP CONSTRAINT IF EXISTS course_collaborators_course_id_fkey,
+    ADD CONSTRAINT course_collaborators_course_id_fkey
+        FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE;
+
+ALTER TABLE content
+    DROP CONSTRAINT IF EXISTS content_course_id_fkey,
+    ADD CONSTRAINT content_course_id_fkey
+        FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE;
+
+ALTER TABLE reviews
+    DROP CONSTRAINT IF EXISTS reviews_course_id_fkey,
+    ADD CONSTRAINT reviews_course_id_fkey
+        FOREIGN KEY (course_id) REFERENCES courses (id) ON DELETE CASCADE;
+
+COMMIT;
@@ -0,0 +1,25 @@
+-- Add content.position and the per-course uniqueness constraints (see db.py).
+-- Existing rows are numbered 1..n per course in id order, i.e. insertion order.
+--   psql "$DATABASE_URL" -f migrations/002_content_position.sql
+-- The name and link constraints fail if a course already holds duplicates; list them with
+--   SELECT course_id, name, count(*) FROM content GROUP BY course_id, name HAVING count(*) > 1;
+--   SELECT course_id, link, count(*) FROM content GROUP BY course_id, link HAVING count(*) > 1;
+BEGIN;
+
+ALTER TABLE content ADD COLUMN position INTEGER;
+
+UPDATE content
+SET position = numbered.position
+FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY course_id ORDER BY id) AS position
+      FROM content) AS numbered
+WHERE content.id = numbered.id;
+
+ALTER TABLE content ALTER COLUMN position SET NOT NULL;
+
+ALTER TABLE content
+    ADD CONSTRAINT content_course_id_position_key
+        UNIQUE (course_id, position) DEFERRABLE INITIALLY DEFERRED,
+    ADD CONSTRAINT content_course_id_link_key UNIQUE (course_id, link),
+    ADD CONSTRAINT content_course_id_name_key UNIQUE (course_id, name);
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Create the append-only course change feed read by GET /courses/changes (see db.CourseChange).
+--   psql "$DATABASE_URL" -f migrations/003_course_changes.sql
+CREATE TABLE IF NOT EXISTS course_changes (
+    seq BIGSERIAL NOT NULL,
+    course_id UUID NOT NULL,
+    kind VARCHAR NOT NULL,
+    data JSON,
+    time_created TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    PRIMARY KEY (seq)
+);
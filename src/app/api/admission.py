@@ -0,0 +1,86 @@
+import asyncio
+from fastapi import HTTPException, Request, status
+
+
+class ConcurrencyLimiter:
+    """Caps the requests running at once for one route, with a bounded wait queue."""
+
+    def __init__(self, limit, max_waiting, timeout):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.waiting = 0
+        self.semaphore = None
+
+    async def acquire(self):
+        # Created lazily so the semaphore belongs to the loop serving requests.
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+        if self.semaphore.locked() and self.waiting >= self.max_waiting:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+
+class AdmissionController:
+    """Router dependency that admits each request through its route's limiter.
+
+    Routes are keyed by endpoint name. Besides its own limit, every route not
+    listed in `unpooled` shares `total_limit` slots, which should match the
+    connections the pool can hand out, and the routes listed in `heavy` also
+    share `heavy_limit` slots so that, kept below `total_limit`, they cannot
+    take the slots cheap routes need. Requests that cannot get a slot within
+    `timeout`, or that find the wait queue full, fail fast with a 503 and a
+    Retry-After header instead of holding a database connection hostage.
+    """
+
+    def __init__(self, default_limit=16, limits=None, total_limit=None, unpooled=(),
+                 heavy=(), heavy_limit=None, max_waiting=32, timeout=2.0, retry_after=1):
+        self.default_limit = default_limit
+        self.limits = limits or {}
+        self.unpooled = set(unpooled)
+        self.heavy = set(heavy)
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.limiters = {}
+        self.total = ConcurrencyLimiter(total_limit, max_waiting, timeout) if total_limit else None
+        self.heavy_total = ConcurrencyLimiter(heavy_limit, max_waiting, timeout) if heavy_limit else None
+
+    def limiter(self, name):
+        if name not in self.limiters:
+            self.limiters[name] = ConcurrencyLimiter(
+                self.limits.get(name, self.default_limit), self.max_waiting, self.timeout)
+        return self.limiters[name]
+
+    def busy(self):
+        return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                             detail='Service busy, retry later.',
+                             headers={'Retry-After': str(self.retry_after)})
+
+    async def __call__(self, request: Request):
+        name = request.scope['endpoint'].__name__
+        limiters = [self.limiter(name)]
+        if name in self.heavy and self.heavy_total is not None:
+            limiters.append(self.heavy_total)
+        if name not in self.unpooled and self.total is not None:
+            limiters.append(self.total)
+        acquired = []
+        try:
+            for limiter in limiters:
+                if not await limiter.acquire():
+                    raise self.busy()
+                acquired.append(limiter)
+            yield
+        finally:
+            for limiter in reversed(acquired):
+                limiter.release()
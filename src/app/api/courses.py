@@ -1,84 +1,334 @@
-from uuid import UUID
+from uuid import UUID, uuid4
+import asyncio
+import codecs
+import csv
+from contextvars import ContextVar
+import json
 import math
-from fastapi import status, APIRouter, Depends, HTTPException
-from fastapi.param_functions import Path, Optional
-from starlette.responses import JSONResponse
-from sqlalchemy.orm import sessionmaker
-
-from api.models import CourseCreate, CourseUpdate, CourseFilter, Hashtags, ReviewCreate, ContentCreate
-from db import Course, Collaborator, Student, Hashtag, Content, Review, User
+from functools import lru_cache
+from typing import List
+from fastapi import status, APIRouter, Depends, HTTPException, Request
+from fastapi.routing import APIRoute
+from fastapi.param_functions import Path, Optional, Query
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from sqlalchemy import bindparam, case, func, insert, literal, select, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session, configure_mappers, scoped_session, sessionmaker
+
+from api.admission import AdmissionController
+from api.cache import CourseCache
+from api.replicas import ReplicaRouter
+from api.similarity import SimilarityIndex
+from api.worker import BackgroundWorker
+from api.models import CourseCreate, CourseUpdate, CourseFilter, CourseImport, Hashtags, ReviewCreate, ContentCreate, ContentMove
+from db import POOL_SIZE, Course, CourseChange, Collaborator, Student, Hashtag, Content, Review, User, course_hashtags, course_students, course_favs
 
 COURSES_PER_PAGE = 5
 REVIEWS_PER_PAGE = 5
-
-router = APIRouter()
+CONTENT_PER_PAGE = 20
+CHANGES_BATCH = 500
+CHANGES_POLL_INTERVAL = 1
+CHANGES_KEEPALIVE_POLLS = 15
+# Advisory lock key serializing change feed writers, so sequence numbers commit in order.
+CHANGE_FEED_LOCK = 3605
+IMPORT_CHUNK_SIZE = 500
+# Postgres' default name for the deferred (course_id, position) constraint on content.
+CONTENT_POSITION_CONSTRAINT = 'content_course_id_position_key'
+SIMILARITY_RETRY_AFTER = 5
+# Carries a writer's primary pin back to us; browsers send the cookie, other clients echo the header.
+PIN_COOKIE = 'read_primary_until'
+PIN_HEADER = 'X-Read-Primary-Until'
+IMPORT_LIST_SEPARATOR = ';'
+
+# Requests share POOL_SIZE slots so they never wait on the pool itself; its overflow
+# is left to the background worker, the replica monitor and the change feed polls.
+# The heavy routes together get at most HEAVY_SLOTS of them, keeping the rest for cheap lookups.
+HEAVY_SLOTS = max(1, POOL_SIZE * 2 // 3)
+admission = AdmissionController(default_limit=POOL_SIZE, total_limit=POOL_SIZE, limits={
+    'get_courses': HEAVY_SLOTS,
+    'get_all_reviews': max(1, HEAVY_SLOTS // 2),
+    'get_dashboard': max(1, HEAVY_SLOTS // 2),
+    'import_courses': 1,
+    # Feed consumers mostly wait between polls instead of holding connections.
+    'get_changes': 64,
+    'stream_changes': 64
+}, heavy=('get_courses', 'get_all_reviews', 'get_dashboard', 'import_courses'), heavy_limit=HEAVY_SLOTS,
+    unpooled=('get_changes', 'stream_changes', 'get_task_metrics'))
 
 session = None
 engine = None
-
-
-def set_engine(engine_rcvd):
+replicas = None
+replica_sessions = {}
+worker = BackgroundWorker()
+cache = CourseCache()
+similarity = SimilarityIndex()
+bus = None
+_read_session = ContextVar('read_session', default=None)
+# Set for clients that wrote recently; they must not be served cached summaries.
+_pinned = ContextVar('pinned', default=False)
+# Keys `session` to the current request; calls made outside a request share one session.
+_request_scope = ContextVar('request_scope', default=None)
+
+
+def set_engine(engine_rcvd, replica_engines=()):
     global engine
     global session
+    global replicas
+    global replica_sessions
     engine = engine_rcvd
-    session = sessionmaker(bind=engine)()
+    session = scoped_session(sessionmaker(bind=engine), scopefunc=_request_scope.get)
+    replicas = ReplicaRouter(engine, replica_engines)
+    replica_sessions = {replica: sessionmaker(bind=replica) for replica in replica_engines}
     return session
 
 
+def set_bus(bus_rcvd):
+    global bus
+    bus = bus_rcvd
+    if bus is not None:
+        bus.start(_on_bus_message, cache.clear)
+
+
+def _on_bus_message(kind, courseIds):
+    if kind == 'cache':
+        cache.evict(courseIds)
+    elif kind == 'similarity':
+        worker.submit('similarity', *[UUID(courseId) for courseId in courseIds])
+
+
+def _notify(db, *courseIds, kind='cache'):
+    """Queue a message for other workers on db's transaction, sent when it commits.
+
+    'cache' evicts the courses' summaries, 'similarity' refreshes their features.
+    """
+    if bus is not None and bus.transactional:
+        bus.publish([str(courseId) for courseId in courseIds], db, kind)
+
+
+def _invalidate(*courseIds):
+    """Evict committed courses from this worker's cache, publishing on buses without transactions."""
+    keys = [str(courseId) for courseId in courseIds]
+    cache.evict(keys)
+    if bus is not None and not bus.transactional:
+        bus.publish(keys)
+
+
+def _features_changed(*courseIds):
+    """Refresh committed courses in this worker's similarity index, publishing on buses without transactions."""
+    worker.submit('similarity', *courseIds)
+    if bus is not None and not bus.transactional:
+        bus.publish([str(courseId) for courseId in courseIds], kind='similarity')
+
+
+def _record_change(kind, *courseIds, **data):
+    """Append feed entries for courseIds to the current transaction."""
+    session.execute(select(func.pg_advisory_xact_lock(CHANGE_FEED_LOCK)))
+    session.execute(insert(CourseChange), [
+        {'course_id': courseId, 'kind': kind, 'data': data or None} for courseId in courseIds])
+
+
+def warm_up():
+    """Configure mappers and run the hot statements once on every engine.
+
+    Executing them, rather than just compiling, is what fills each engine's
+    compiled cache, so the first real requests skip statement compilation.
+    """
+    configure_mappers()
+    nil = UUID(int=0)
+    for bind in [engine] + replicas.replicas:
+        with Session(bind) as db:
+            db.get(Course, nil)
+            filter_courses(db, CourseFilter(hashtags=None), 1)
+            filter_courses(db, CourseFilter(name='', hashtags=['']), 1)
+            db.execute(_dashboard_query(nil)).all()
+            db.query(Content).filter(Content.course_id == nil).order_by(Content.position).all()
+            db.query(Collaborator).filter(
+                (Collaborator.course_id == nil) & (Collaborator.accepted == True)).all()
+        _changes_after(bind, 0, 1)
+
+
+def reader():
+    """Session for the current request's reads: a replica for GETs, else the primary."""
+    return _read_session.get() or session
+
+
+def _pinned_until(request):
+    try:
+        return float(request.headers.get(PIN_HEADER) or request.cookies.get(PIN_COOKIE) or 0)
+    except ValueError:
+        return 0
+
+
+async def route_session(request: Request):
+    """Give the request its own session, reading from a replica for GETs."""
+    _request_scope.set(object())
+    db = None
+    if request.method == 'GET':
+        pinned_until = _pinned_until(request)
+        _pinned.set(replicas.is_pinned(pinned_until))
+        replica = replicas.reader(pinned_until)
+        if replica is not engine:
+            db = replica_sessions[replica]()
+            _read_session.set(db)
+    try:
+        yield
+    finally:
+        # Returning the connections issues a ROLLBACK, so keep it off the loop.
+        await run_in_threadpool(_close_sessions, db)
+
+
+def _close_sessions(db):
+    if db is not None:
+        db.close()
+    session.remove()
+
+
+class PinningRoute(APIRoute):
+    """Route that pins the client to the primary after a successful write."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def pin_writer(request: Request):
+            response = await handler(request)
+            if request.method != 'GET' and response.status_code < 400:
+                until = f'{replicas.pin_until():.3f}'
+                response.headers[PIN_HEADER] = until
+                response.set_cookie(PIN_COOKIE, until, max_age=replicas.pin_seconds, httponly=True)
+            return response
+
+        return pin_writer
+
+
+router = APIRouter(route_class=PinningRoute, dependencies=[Depends(admission), Depends(route_session)])
+
+
+def _recompute_ratings(courseIds):
+    average = select(func.coalesce(func.avg(Review.rating), 0)).where(
+        Review.course_id == Course.id).scalar_subquery()
+    with Session(engine) as db:
+        db.query(Course).filter(Course.id.in_(courseIds)).update(
+            {Course.rating: average}, synchronize_session=False)
+        _notify(db, *courseIds)
+        db.commit()
+    _invalidate(*courseIds)
+
+
+worker.register('rating', _recompute_ratings)
+
+
+def _course_features(db, courseIds=None):
+    features = {courseId: set() for courseId in courseIds or ()}
+    sources = (('hashtag', course_hashtags.c.hashtag_id),
+               ('student', course_students.c.student_id),
+               ('fav', course_favs.c.user_id))
+    for kind, column in sources:
+        query = select(column.table.c.course_id, column)
+        if courseIds is not None:
+            query = query.where(column.table.c.course_id.in_(courseIds))
+        for courseId, value in db.execute(query):
+            features.setdefault(courseId, set()).add((kind, value))
+    return features
+
+
+def _load_features():
+    with Session(engine) as db:
+        return _course_features(db)
+
+
+def rebuild_similarity():
+    similarity.rebuild(_load_features)
+
+
+def _refresh_similarity(courseIds):
+    with Session(engine) as db:
+        for courseId, features in _course_features(db, courseIds).items():
+            similarity.update(courseId, features)
+
+
+worker.register('similarity', _refresh_similarity)
+
+
 def check_course(courseId: UUID):
-    course = session.get(Course, courseId)
+    course = reader().get(Course, courseId)
     if course is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail='Course not found.')
     return course
 
 
+# One clause per CourseFilter field, with only the value left as a bound parameter.
+FILTER_CLAUSES = {
+    'id': Course.id == bindparam('id'),
+    'name': Course.name.ilike(bindparam('name')),
+    'owner': Course.owner == bindparam('owner'),
+    'description': Course.description.ilike(bindparam('description')),
+    'sub_level': Course.sub_level == bindparam('sub_level'),
+    'latitude': Course.latitude == bindparam('latitude'),
+    'longitude': Course.longitude == bindparam('longitude'),
+    'student': Course.students.any(Student.user_id == bindparam('student')),
+    'collaborator': Course.collaborators.any(
+        (Collaborator.accepted == True) & (Collaborator.user_id == bindparam('collaborator'))),
+    'minRating': Course.rating >= bindparam('minRating'),
+    'category': Course.category == bindparam('category'),
+    'faved_by': Course.faved_by.any(User.user_id == bindparam('faved_by')),
+    'inEdition': Course.in_edition == bindparam('inEdition'),
+    'blocked': Course.blocked == bindparam('blocked')
+}
+
+
+@lru_cache(maxsize=256)
+def _filter_statements(present, tag_count):
+    """Count and page statements for one combination of filters, built once and reused.
+
+    Reusing the same statement objects lets SQLAlchemy's compiled cache serve
+    every request with that combination; only the bound values change.
+    """
+    clauses = [FILTER_CLAUSES[name] for name in present] + [
+        Course.hashtags.any(Hashtag.tag == bindparam(f'tag_{i}')) for i in range(tag_count)]
+    count = select(func.count()).select_from(Course).where(*clauses)
+    page = select(Course).where(*clauses).limit(COURSES_PER_PAGE).offset(bindparam('offset'))
+    return count, page
+
+
+def filter_courses(db, filter: CourseFilter, page_num: int):
+    params = {name: getattr(filter, name) for name in FILTER_CLAUSES}
+    for name in ('name', 'description'):
+        if params[name] is not None:
+            params[name] = f'%{params[name]}%'
+    params = {name: value for name, value in params.items() if value is not None}
+    tags = filter.hashtags or []
+    params.update({f'tag_{i}': tag for i, tag in enumerate(tags)})
+    count, page = _filter_statements(tuple(name for name in FILTER_CLAUSES if name in params), len(tags))
+    num_pages = math.ceil(db.execute(count, params).scalar()/COURSES_PER_PAGE)
+    params['offset'] = (page_num-1)*COURSES_PER_PAGE
+    return num_pages, db.execute(page, params).scalars().all()
+
+
 @router.get('/all/{page_num}')
-async def get_courses(
+def get_courses(
     page_num: int = Path(..., gt=0),
     filter: CourseFilter = Depends()
 ):
-    query = session.query(Course)
-    if filter.id is not None:
-        query = query.filter(Course.id == filter.id)
-    if filter.name is not None:
-        query = query.filter(Course.name.ilike(f'%{filter.name}%'))
-    if filter.owner is not None:
-        query = query.filter(Course.owner == filter.owner)
-    if filter.description is not None:
-        query = query.filter(
-            Course.description.ilike(f'%{filter.description}%'))
-    if filter.sub_level is not None:
-        query = query.filter(Course.sub_level == filter.sub_level)
-    if filter.latitude is not None:
-        query = query.filter(Course.latitude == filter.latitude)
-    if filter.longitude is not None:
-        query = query.filter(Course.longitude == filter.longitude)
-    if filter.student is not None:
-        query = query.filter(
-            Course.students.any(user_id=filter.student))
-    if filter.collaborator is not None:
-        query = query.join(Collaborator).filter((Collaborator.accepted == True) & (
-            Collaborator.user_id == filter.collaborator))
-    if filter.hashtags is not None:
-        for tag in filter.hashtags:
-            query = query.filter(
-                Course.hashtags.any(tag=tag))
-    if filter.minRating is not None:
-        query = query.filter(Course.rating >= filter.minRating)
-    if filter.category is not None:
-        query = query.filter(Course.category == filter.category)
-    if filter.faved_by is not None:
-        query = query.filter(Course.faved_by.any(user_id=filter.faved_by))
-    if filter.inEdition is not None:
-        query = query.filter(Course.in_edition == filter.inEdition)
-    if filter.blocked is not None:
-        query = query.filter(Course.blocked == filter.blocked)
-
-    num_pages = math.ceil(query.count()/COURSES_PER_PAGE)
-    query.order_by(Course.rating)
-    query = query.limit(COURSES_PER_PAGE).offset((page_num-1)*COURSES_PER_PAGE)
-    return {'num_pages': num_pages, 'content': [{
+    num_pages, courses = filter_courses(reader(), filter, page_num)
+    return {'num_pages': num_pages, 'content': [_course_summary(course) for course in courses]}
+
+
+def _course_summary(course):
+    """Summary of a course, cached across requests.
+
+    Writers evict their courses, so a recent writer skips the cache to see its
+    own write, and only primary reads fill it: a lagging replica could put the
+    old summary back right after the eviction.
+    """
+    if not _pinned.get():
+        summary = cache.get(str(course.id))
+        if summary is not None:
+            return summary
+    summary = {
         'id': str(course.id),
         'name': course.name,
         'description': course.description,
@@ -93,28 +343,45 @@ async def get_courses(
         'in_edition': course.in_edition,
         'ratingCount': len(course.reviews),
         'ratingAvg': course.rating
-    } for course in query]}
+    }
+    if _read_session.get() is None:
+        cache.set(summary['id'], summary)
+    return summary
+
+
+@ router.get('/{courseId}/similar')
+def get_similar(k: int = Query(10, gt=0, le=50), course=Depends(check_course)):
+    if not similarity.ready:
+        # The first build runs at startup; don't let every early request start its own scan.
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Similarity index is still building.',
+                            headers={'Retry-After': str(SIMILARITY_RETRY_AFTER)})
+    scores = similarity.similar(course.id, k)
+    names = dict(reader().query(Course.id, Course.name).filter(
+        Course.id.in_([courseId for courseId, _ in scores])))
+    return [{'id': str(courseId), 'name': names[courseId], 'score': score}
+            for courseId, score in scores if courseId in names]
 
 
 @ router.get('/{courseId}/students')
-async def get_students(course=Depends(check_course)):
+def get_students(course=Depends(check_course)):
     return [user.user_id for user in course.students]
 
 
 @ router.get('/{courseId}/collaborators')
-async def get_collaborators(course=Depends(check_course)):
-    collaborators = session.query(Collaborator).filter(
+def get_collaborators(course=Depends(check_course)):
+    collaborators = reader().query(Collaborator).filter(
         (Collaborator.course_id == course.id) & (Collaborator.accepted == True))
     return [collaborator.user_id for collaborator in collaborators]
 
 
 @ router.get('/{courseId}/owner')
-async def get_owner(course=Depends(check_course)):
+def get_owner(course=Depends(check_course)):
     return {"ownerId": course.owner}
 
 
 @ router.get('/{courseId}/review/{userId}')
-async def get_review(userId: UUID, course=Depends(check_course)):
+def get_review(userId: UUID, course=Depends(check_course)):
     try:
         review = next(
             review for review in course.reviews if (review.user_id == userId))
@@ -124,7 +391,7 @@ async def get_review(userId: UUID, course=Depends(check_course)):
 
 
 @ router.get('/{courseId}/all_reviews/{pagenum}')
-async def get_all_reviews(pagenum: int = Path(..., gt=0), ratingFilter: Optional[int] = None, course=Depends(check_course)):
+def get_all_reviews(pagenum: int = Path(..., gt=0), ratingFilter: Optional[int] = None, course=Depends(check_course)):
     reviews = course.reviews
     if ratingFilter is not None:
         reviews = [review for review in reviews if review.rating == ratingFilter] 
@@ -139,19 +406,126 @@ async def get_all_reviews(pagenum: int = Path(..., gt=0), ratingFilter: Optional
 
 
 @ router.get('/{courseId}/get_content_list')
-async def get_content_list(course=Depends(check_course)):
-    return [{'id': content.id, 'name': content.name, 'link': content.link} for content in course.content]
+def get_content_list(course=Depends(check_course)):
+    contents = reader().query(Content).filter(Content.course_id == course.id).order_by(Content.position)
+    return [{'id': content.id, 'name': content.name, 'link': content.link} for content in contents]
+
+
+@ router.get('/{courseId}/content/{pagenum}')
+def get_content_page(pagenum: int = Path(..., gt=0), course=Depends(check_course)):
+    contents = reader().query(Content).filter(Content.course_id == course.id)
+    num_pages = math.ceil(contents.count()/CONTENT_PER_PAGE)
+    contents = contents.order_by(Content.position).limit(
+        CONTENT_PER_PAGE).offset(CONTENT_PER_PAGE*(pagenum-1))
+    return {'num_pages': num_pages, 'content': [{
+        'id': content.id,
+        'name': content.name,
+        'link': content.link,
+        'position': content.position
+    } for content in contents]}
 
 
 @ router.get('/pending_collaborations/{userId}')
-async def get_pending_collaborations(userId: UUID):
-    collaborators = session.query(Collaborator).filter(
+def get_pending_collaborations(userId: UUID):
+    collaborators = reader().query(Collaborator).filter(
         (Collaborator.user_id == userId) & (Collaborator.accepted == False))
     return [{'courseId': collaborator.course_id} for collaborator in collaborators]
 
 
+@ router.get('/tasks/metrics')
+async def get_task_metrics():
+    return worker.status()
+
+
+def _changes_after(bind, seq, limit):
+    with Session(bind) as db:
+        changes = db.query(CourseChange).filter(
+            CourseChange.seq > seq).order_by(CourseChange.seq).limit(limit)
+        return [{
+            'seq': change.seq,
+            'courseId': str(change.course_id),
+            'kind': change.kind,
+            'data': change.data,
+            'time_created': change.time_created.isoformat()
+        } for change in changes]
+
+
+@ router.get('/changes')
+async def get_changes(after: int = 0, limit: int = Query(CHANGES_BATCH, gt=0, le=CHANGES_BATCH),
+                      wait: int = Query(0, ge=0, le=30)):
+    """Long-poll the change feed: waits up to `wait` seconds for changes after `after`."""
+    bind = reader().get_bind()
+    for _ in range(wait // CHANGES_POLL_INTERVAL):
+        changes = await run_in_threadpool(_changes_after, bind, after, limit)
+        if changes:
+            break
+        await asyncio.sleep(CHANGES_POLL_INTERVAL)
+    else:
+        changes = await run_in_threadpool(_changes_after, bind, after, limit)
+    return {'cursor': changes[-1]['seq'] if changes else after, 'changes': changes}
+
+
+@ router.get('/changes/stream')
+async def stream_changes(request: Request, after: int = 0):
+    """Server-Sent Events feed; each event carries a batch of changes and its last seq as id."""
+    try:
+        cursor = int(request.headers.get('last-event-id', after))
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='Last-Event-ID must be a change seq.')
+    bind = reader().get_bind()
+
+    async def events():
+        nonlocal cursor
+        idle = 0
+        while not await request.is_disconnected():
+            changes = await run_in_threadpool(_changes_after, bind, cursor, CHANGES_BATCH)
+            if changes:
+                cursor = changes[-1]['seq']
+                idle = 0
+                yield f'id: {cursor}\nevent: changes\ndata: {json.dumps(changes)}\n\n'
+                continue
+            idle += 1
+            if idle % CHANGES_KEEPALIVE_POLLS == 0:
+                yield ': keep-alive\n\n'
+            await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+def _dashboard_query(userId):
+    relations = union_all(
+        select(course_students.c.course_id, literal('enrolled').label('relation')).where(
+            course_students.c.student_id == userId),
+        select(Course.id, literal('owned')).where(Course.owner == userId),
+        select(Collaborator.course_id, literal('collaborating')).where(
+            (Collaborator.user_id == userId) & (Collaborator.accepted == True)),
+        select(course_favs.c.course_id, literal('favorites')).where(
+            course_favs.c.user_id == userId),
+        select(Collaborator.course_id, literal('pending')).where(
+            (Collaborator.user_id == userId) & (Collaborator.accepted == False))
+    ).cte('relations')
+    return select(relations.c.relation, Course.id, Course.name, Course.category, Course.rating,
+                  Course.in_edition, Course.blocked).join(Course, Course.id == relations.c.course_id)
+
+
+@ router.get('/dashboard/{userId}')
+def get_dashboard(userId: UUID):
+    dashboard = {relation: [] for relation in ('enrolled', 'owned', 'collaborating', 'favorites', 'pending')}
+    for row in reader().execute(_dashboard_query(userId)):
+        dashboard[row.relation].append({
+            'id': str(row.id),
+            'name': row.name,
+            'category': row.category,
+            'ratingAvg': row.rating,
+            'in_edition': row.in_edition,
+            'blocked': row.blocked
+        })
+    return dashboard
+
+
 @ router.patch('/{courseId}')
-async def update(request: CourseUpdate, course=Depends(check_course)):
+def update(request: CourseUpdate, course=Depends(check_course)):
     attributes = request.dict(
         exclude_unset=True, exclude_none=True, exclude={'hashtags'})
     for att, value in attributes.items():
@@ -165,12 +539,19 @@ async def update(request: CourseUpdate, course=Depends(check_course)):
             else:
                 course.hashtags.append(hashtag)
     session.merge(course)
+    _record_change('updated', course.id, **json.loads(request.json(exclude_unset=True, exclude_none=True)))
+    _notify(session, course.id)
+    if request.hashtags is not None:
+        _notify(session, course.id, kind='similarity')
     session.commit()
+    _invalidate(course.id)
+    if request.hashtags is not None:
+        _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Course updated succesfully.')
 
 
 @ router.post('')
-async def create(request: CourseCreate):
+def create(request: CourseCreate):
     new = Course(**request.dict(exclude_unset=True, exclude={"hashtags"}))
     for tag in request.hashtags:
         hashtag = session.query(Hashtag).filter(Hashtag.tag == tag).first()
@@ -179,12 +560,151 @@ async def create(request: CourseCreate):
         elif hashtag not in new.hashtags:
             new.hashtags.append(hashtag)
     session.add(new)
+    session.flush()
+    _record_change('created', new.id)
+    _notify(session, new.id, kind='similarity')
     session.commit()
+    _features_changed(new.id)
     return {'courseId': str(new.id)}
 
 
+async def _stream_lines(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            yield line
+    buffer += decoder.decode(b'', final=True)
+    if buffer:
+        yield buffer
+
+
+def _csv_record(header, line):
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f'Expected {len(header)} columns, got {len(values)}.')
+    record = {field: value for field, value in zip(header, values) if value != ''}
+    for field in ('hashtags', 'collaborators'):
+        if field in record:
+            record[field] = [item.strip() for item in record[field].split(
+                IMPORT_LIST_SEPARATOR) if item.strip()]
+    if 'content' in record:
+        record['content'] = json.loads(record['content'])
+    return record
+
+
+async def _parse_import(lines, format):
+    """Yield (line number, CourseImport or error detail) for every non-empty line."""
+    header = None
+    line_num = 0
+    async for line in lines:
+        line_num += 1
+        line = line.strip()
+        if line == '':
+            continue
+        if format == 'csv' and header is None:
+            header = [field.strip() for field in next(csv.reader([line]))]
+            continue
+        try:
+            record = _csv_record(header, line) if format == 'csv' else json.loads(line)
+            yield line_num, CourseImport.parse_obj(record)
+        except ValidationError as e:
+            yield line_num, e.errors()
+        except ValueError as e:
+            yield line_num, str(e)
+
+
+def _resolve_hashtags(tags):
+    if not tags:
+        return {}
+    hashtag_ids = dict(session.query(Hashtag.tag, Hashtag.id).filter(Hashtag.tag.in_(tags)))
+    missing = tags - hashtag_ids.keys()
+    if missing:
+        session.execute(pg_insert(Hashtag).values(
+            [{'id': uuid4(), 'tag': tag} for tag in missing]).on_conflict_do_nothing(index_elements=['tag']))
+        hashtag_ids.update(session.query(Hashtag.tag, Hashtag.id).filter(Hashtag.tag.in_(missing)))
+    return hashtag_ids
+
+
+def _import_chunk(records):
+    """Insert a chunk of CourseImport records with one multi-row insert per table."""
+    hashtag_ids = _resolve_hashtags({tag for record in records for tag in record.hashtags})
+    courses, tags, contents, collaborators = [], [], [], []
+    for record in records:
+        course_id = uuid4()
+        courses.append({'id': course_id, **record.dict(exclude={'hashtags', 'content', 'collaborators'})})
+        tags += [{'course_id': course_id, 'hashtag_id': hashtag_ids[tag]} for tag in set(record.hashtags)]
+        contents += [{'course_id': course_id, 'position': position, **content.dict()}
+                     for position, content in enumerate(record.content, 1)]
+        collaborators += [{'course_id': course_id, 'user_id': user_id, 'accepted': False}
+                          for user_id in set(record.collaborators)]
+    session.execute(insert(Course), courses)
+    if tags:
+        session.execute(course_hashtags.insert(), tags)
+    if contents:
+        session.execute(insert(Content), contents)
+    if collaborators:
+        session.execute(insert(Collaborator), collaborators)
+    _record_change('created', *[course['id'] for course in courses])
+    _notify(session, *[course['id'] for course in courses], kind='similarity')
+    return [str(course['id']) for course in courses]
+
+
+def _commit_chunk(chunk, created, errors):
+    try:
+        courseIds = _import_chunk([record for _, record in chunk])
+        session.commit()
+        created += courseIds
+        return
+    except SQLAlchemyError:
+        session.rollback()
+    # Retry one record per transaction so a single bad row does not sink its chunk.
+    for line_num, record in chunk:
+        try:
+            courseIds = _import_chunk([record])
+            session.commit()
+            created += courseIds
+        except SQLAlchemyError as e:
+            session.rollback()
+            errors.append({'line': line_num, 'detail': str(getattr(e, 'orig', e))})
+
+
+async def import_lines(lines, format='ndjson'):
+    created, errors, chunk = [], [], []
+    try:
+        async for line_num, result in _parse_import(lines, format):
+            if not isinstance(result, CourseImport):
+                errors.append({'line': line_num, 'detail': result})
+                continue
+            chunk.append((line_num, result))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                await run_in_threadpool(_commit_chunk, chunk, created, errors)
+                chunk = []
+    except UnicodeDecodeError:
+        # Chunks before the bad bytes are already committed; report them with the error.
+        _features_changed(*[UUID(courseId) for courseId in created])
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={
+            'error': 'Request body is not valid UTF-8.', 'created': len(created), 'courseIds': created})
+    if chunk:
+        await run_in_threadpool(_commit_chunk, chunk, created, errors)
+    _features_changed(*[UUID(courseId) for courseId in created])
+    return {'created': len(created), 'failed': len(errors), 'courseIds': created, 'errors': errors}
+
+
+@ router.post('/import')
+async def import_courses(request: Request, format: Optional[str] = None):
+    if format is None:
+        format = 'csv' if 'csv' in request.headers.get('content-type', '') else 'ndjson'
+    if format not in ('ndjson', 'csv'):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='Format must be ndjson or csv.')
+    return await import_lines(_stream_lines(request.stream()), format)
+
+
 @ router.post('/{courseId}/add_student/{userId}')
-async def add_student(userId: UUID, course=Depends(check_course)):
+def add_student(userId: UUID, course=Depends(check_course)):
     student = session.get(Student, userId)
     if student is None:
         course.students.append(Student(user_id=userId))
@@ -192,24 +712,28 @@ async def add_student(userId: UUID, course=Depends(check_course)):
         course.students.append(student)
     else:
         return JSONResponse(status_code=status.HTTP_409_CONFLICT, content='Student already existed.')
+    _record_change('student_added', course.id, userId=str(userId))
+    _notify(session, course.id, kind='similarity')
     session.commit()
+    _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_201_CREATED, content='Student added succesfully.')
 
 
 @ router.post('/{courseId}/add_collaborator/{userId}')
-async def add_collaborator(userId: UUID, course=Depends(check_course)):
+def add_collaborator(userId: UUID, course=Depends(check_course)):
     collaborator = session.query(Collaborator).filter(
         (Collaborator.course_id == course.id) & (Collaborator.user_id == userId)).first()
     if collaborator is not None:
         return JSONResponse(status_code=status.HTTP_409_CONFLICT, content='User already invited.')
     session.add(Collaborator(course_id=course.id,
                 user_id=userId, accepted=False))
+    _record_change('collaborator_invited', course.id, userId=str(userId))
     session.commit()
     return JSONResponse(status_code=status.HTTP_201_CREATED, content='Collaborator invite sent succesfully.')
 
 
 @ router.post('/{courseId}/accept_collaborator/{userId}')
-async def accept_collaborator(userId: UUID, course=Depends(check_course)):
+def accept_collaborator(userId: UUID, course=Depends(check_course)):
     accepted = session.query(Collaborator).filter((Collaborator.course_id == course.id) & (
         Collaborator.user_id == userId) & (Collaborator.accepted == True)).first()
     if accepted is not None:
@@ -220,12 +744,13 @@ async def accept_collaborator(userId: UUID, course=Depends(check_course)):
     if invite is None:
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='Collaborator invite not found.')
     invite.accepted = True
+    _record_change('collaborator_accepted', course.id, userId=str(userId))
     session.commit()
     return JSONResponse(status_code=status.HTTP_201_CREATED, content='Collaborator added succesfully.')
 
 
 @ router.post('/{courseId}/add_hashtags')
-async def add_hashtags(tags: Hashtags, course=Depends(check_course)):
+def add_hashtags(tags: Hashtags, course=Depends(check_course)):
     response = ""
     for tag in tags.tags:
         hashtag = session.query(Hashtag).filter(Hashtag.tag == tag).first()
@@ -237,32 +762,89 @@ async def add_hashtags(tags: Hashtags, course=Depends(check_course)):
             response += f'\'{tag}\', '
     if response == "":
         return JSONResponse(status_code=status.HTTP_409_CONFLICT, content='Tags already existed.')
+    _record_change('hashtags_added', course.id, tags=tags.tags)
+    _notify(session, course.id)
+    _notify(session, course.id, kind='similarity')
     session.commit()
+    _invalidate(course.id)
+    _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_201_CREATED, content=f'Hashtag {response[:-2]} added succesfully.')
 
 
 @ router.post('/{courseId}/add_content')
-async def add_content(new: ContentCreate, course=Depends(check_course)):
-    for content in course.content:
-        if content.link == new.link or content.name == new.name:
-            return JSONResponse(status_code=status.HTTP_409_CONFLICT, content='Content already exists.')
+def add_content(new: ContentCreate, course=Depends(check_course)):
+    return add_content_bulk([new], course)
 
-    course.content.append(Content(**new.dict()))
-    session.commit()
+
+def _lock_content(courseId):
+    """Lock the course row so concurrent appends and reorders of its content take turns."""
+    session.query(Course.id).filter(Course.id == courseId).with_for_update().scalar()
+
+
+def _last_position(courseId):
+    return session.query(func.coalesce(func.max(Content.position), 0)).filter(
+        Content.course_id == courseId).scalar()
+
+
+def _violated_constraint(error):
+    return getattr(getattr(error.orig, 'diag', None), 'constraint_name', None)
+
+
+@ router.post('/{courseId}/add_content_bulk')
+def add_content_bulk(contents: List[ContentCreate], course=Depends(check_course)):
+    if not contents:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='No content given.')
+    # Duplicate names or links are rejected by the (course_id, name/link) unique constraints.
+    _lock_content(course.id)
+    start = _last_position(course.id) + 1
+    try:
+        session.execute(insert(Content), [{'course_id': course.id, 'position': position, **content.dict()}
+                                          for position, content in enumerate(contents, start)])
+        _record_change('content_added', course.id, names=[content.name for content in contents])
+        session.commit()
+    except IntegrityError as e:
+        session.rollback()
+        if _violated_constraint(e) == CONTENT_POSITION_CONSTRAINT:
+            return JSONResponse(status_code=status.HTTP_409_CONFLICT,
+                                content='Content positions changed concurrently, retry.')
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content='Content already exists.')
     return JSONResponse(status_code=status.HTTP_201_CREATED, content='Content added succesfully.')
 
 
+@ router.put('/{courseId}/content_order')
+def reorder_content(moves: List[ContentMove], course=Depends(check_course)):
+    positions = {move.id: move.position for move in moves}
+    _lock_content(course.id)
+    moved = session.query(Content).filter((Content.course_id == course.id) & Content.id.in_(positions)).update(
+        {Content.position: case(positions, value=Content.id)}, synchronize_session=False)
+    if moved != len(positions):
+        session.rollback()
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='Content not found.')
+    _record_change('content_reordered', course.id)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content='Content positions collide.')
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Content reordered succesfully.')
+
+
 @ router.delete('/{courseId}', summary='Delete course')
-async def delete(course=Depends(check_course)):
-    session.query(Collaborator).filter(
-        Collaborator.course_id == course.id).delete()
-    session.delete(course)
+def delete(course=Depends(check_course)):
+    # Children and association rows go through ON DELETE CASCADE, so nothing is loaded here.
+    _record_change('deleted', course.id)
+    session.query(Course).filter(Course.id == course.id).delete()
+    _notify(session, course.id)
+    _notify(session, course.id, kind='similarity')
     session.commit()
+    _invalidate(course.id)
+    _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Course deleted succesfully.')
 
 
 @ router.delete('/{courseId}/remove_student/{userId}')
-async def remove_student(userId: UUID, course=Depends(check_course)):
+def remove_student(userId: UUID, course=Depends(check_course)):
     removed = False
     for student in course.students:
         if student.user_id == userId:
@@ -271,24 +853,28 @@ async def remove_student(userId: UUID, course=Depends(check_course)):
             break
     if not removed:
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='No student found.')
+    _record_change('student_removed', course.id, userId=str(userId))
+    _notify(session, course.id, kind='similarity')
     session.commit()
+    _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Student was removed succesfully.')
 
 
 @ router.delete('/{courseId}/remove_collaborator/{userId}')
-async def remove_collaborator(userId: UUID, course=Depends(check_course)):
+def remove_collaborator(userId: UUID, course=Depends(check_course)):
     collaborator = session.query(Collaborator).filter(
         (Collaborator.user_id == userId) & (Collaborator.course_id == course.id)).first()
     if collaborator is None:
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='No collaborator found.')
     session.query(Collaborator).filter((Collaborator.user_id == userId) & (
         Collaborator.course_id == course.id)).delete()
+    _record_change('collaborator_removed', course.id, userId=str(userId))
     session.commit()
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Collaborator was removed succesfully.')
 
 
 @ router.delete('/{courseId}/remove_hashtags')
-async def remove_hashtags(tags: Hashtags, course=Depends(check_course)):
+def remove_hashtags(tags: Hashtags, course=Depends(check_course)):
     response = ""
     for tag in tags.tags:
         for hashtag in course.hashtags:
@@ -298,53 +884,64 @@ async def remove_hashtags(tags: Hashtags, course=Depends(check_course)):
                 break
     if response == "":
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content='No hashtags found.')
+    _record_change('hashtags_removed', course.id, tags=tags.tags)
+    _notify(session, course.id)
+    _notify(session, course.id, kind='similarity')
     session.commit()
+    _invalidate(course.id)
+    _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=f'Hashtag {response[:-2]} removed succesfully.')
 
 
 @ router.delete('/remove_content/{contentId}')
-async def remove_content(contentId: str):
+def remove_content(contentId: str):
     content = session.get(Content, contentId)
     if content is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail='Content not found.')
     session.delete(content)
+    _record_change('content_removed', content.course_id, contentId=content.id)
     session.commit()
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Content deleted succesfully.')
 
 
 @ router.put('/{courseId}/block')
-async def set_block(block: bool = True, course=Depends(check_course)):
+def set_block(block: bool = True, course=Depends(check_course)):
     course.blocked = block
+    _record_change('blocked', course.id, blocked=block)
+    _notify(session, course.id)
     session.commit()
+    _invalidate(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Course block status updated succesfully.')
 
 
 @ router.put('/{courseId}/status')
-async def set_status(in_edition: bool, course=Depends(check_course)):
+def set_status(in_edition: bool, course=Depends(check_course)):
     course.in_edition = in_edition
+    _record_change('status', course.id, in_edition=in_edition)
+    _notify(session, course.id)
     session.commit()
+    _invalidate(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Course edition status updated succesfully.')
 
 
 @ router.put('/{courseId}/review')
-async def add_review(new: ReviewCreate, course=Depends(check_course)):
+def add_review(new: ReviewCreate, course=Depends(check_course)):
     new = Review(**new.dict())
     new.course_id = course.id
-    try:
-        new.id = next(
-            review for review in course.reviews if review.user_id == new.user_id).id
-    except StopIteration:
-        pass
+    new.id = session.query(Review.id).filter(
+        (Review.course_id == course.id) & (Review.user_id == new.user_id)).scalar()
     session.merge(new)
+    _record_change('reviewed', course.id, userId=str(new.user_id), rating=new.rating)
+    _notify(session, course.id)
     session.commit()
-    course.rating = (sum([r.rating for r in course.reviews]))/len(course.reviews)
-    session.commit()
+    _invalidate(course.id)
+    worker.submit('rating', course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Review added succesfully.')
 
 
 @ router.put('/new_fav/{userId}/{courseId}/{fav}')
-async def fav_course(fav: bool, userId: UUID, course=Depends(check_course)):
+def fav_course(fav: bool, userId: UUID, course=Depends(check_course)):
     user = session.get(User, userId)
     if fav is True:
         if user is None:
@@ -356,5 +953,8 @@ async def fav_course(fav: bool, userId: UUID, course=Depends(check_course)):
             if user.user_id == userId:
                 course.faved_by.remove(user)
                 break
+    _record_change('fav', course.id, userId=str(userId), fav=fav)
+    _notify(session, course.id, kind='similarity')
     session.commit()
+    _features_changed(course.id)
     return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content='Fav updated succesfully.')
@@ -0,0 +1,150 @@
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from uuid import uuid4
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Postgres caps NOTIFY payloads at 8000 bytes; a course id takes 37 with its separator.
+MAX_IDS_PER_MESSAGE = 150
+
+
+def _chunks(kind, ids):
+    """Encode ids as 'kind:id,id,...' messages small enough for NOTIFY."""
+    ids = list(ids)
+    for start in range(0, len(ids), MAX_IDS_PER_MESSAGE):
+        yield f'{kind}:' + ','.join(ids[start:start + MAX_IDS_PER_MESSAGE])
+
+
+def _decode(payload):
+    kind, _, ids = payload.partition(':')
+    return kind, ids.split(',')
+
+
+class PostgresBus:
+    """Invalidation bus over Postgres LISTEN/NOTIFY.
+
+    Messages carry a kind and course ids; `on_message(kind, ids)` receives them.
+
+    Each process keeps one dedicated listening connection outside the pool,
+    opened by the listener thread so a database outage at boot only delays it.
+    If that connection drops, `on_reset` is called after reconnecting since
+    messages sent in between are lost. Messages are published on the writer's
+    own transaction, so Postgres delivers them only once it commits.
+    """
+
+    channel = 'course_invalidation'
+    transactional = True
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, on_message, on_reset):
+        self.on_message = on_message
+        self.on_reset = on_reset
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def publish(self, ids, db, kind='cache'):
+        for payload in _chunks(kind, ids):
+            db.execute(text('SELECT pg_notify(:channel, :payload)'),
+                       {'channel': self.channel, 'payload': payload})
+
+    def _listen(self):
+        cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+        connection = self.engine.dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        connection.cursor().execute(f'LISTEN {self.channel}')
+        return connection
+
+    def _run(self):
+        connection = self._reconnect(None)
+        while not self.stopped.is_set():
+            try:
+                if select.select([connection], [], [], 1)[0]:
+                    connection.poll()
+                    while connection.notifies:
+                        self.on_message(*_decode(connection.notifies.pop(0).payload))
+            except Exception:
+                logger.exception('Lost the invalidation listener connection, reconnecting.')
+                connection = self._reconnect(connection)
+        if connection is not None:
+            connection.close()
+
+    def _reconnect(self, connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        while not self.stopped.is_set():
+            try:
+                connection = self._listen()
+                self.on_reset()
+                return connection
+            except Exception:
+                logger.warning('Could not open the invalidation listener connection, retrying.')
+                time.sleep(1)
+        return connection
+
+
+class SocketBus:
+    """Invalidation bus over Unix datagram sockets, for hosts without Postgres.
+
+    Every subscribed process binds a socket inside `directory`; publishing sends
+    the ids to every socket found there, after the write has committed.
+    """
+
+    transactional = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.sock = None
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def start(self, on_message, on_reset=None):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'{os.getpid()}-{uuid4().hex}.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1)
+        self.on_message = on_message
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        if self.sock is not None:
+            os.unlink(self.path)
+            self.sock.close()
+            self.sock = None
+
+    def publish(self, ids, db=None, kind='cache'):
+        for name in os.listdir(self.directory):
+            if not name.endswith('.sock'):
+                continue
+            for payload in _chunks(kind, ids):
+                try:
+                    self.sender.sendto(payload.encode(), os.path.join(self.directory, name))
+                except (ConnectionRefusedError, FileNotFoundError):
+                    break
+
+    def _run(self):
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except (OSError, AttributeError):
+                break
+            self.on_message(*_decode(data.decode()))
@@ -70,7 +70,18 @@ class ContentCreate(BaseModel):
     link: str
 
 
+class ContentMove(BaseModel):
+    id: int
+    position: int = Field(..., ge=1)
+
+
 class ReviewCreate(BaseModel):
     user_id: UUID
     description: Optional[str] = Field(None, max_length=500)
     rating: int = Field(..., ge=1, le=5)
+
+
+class CourseImport(CourseCreate):
+    hashtags: List[str] = []
+    content: List[ContentCreate] = []
+    collaborators: List[UUID] = []
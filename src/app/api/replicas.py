@@ -0,0 +1,53 @@
+import asyncio
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class ReplicaRouter:
+    """Picks the engine a request reads from.
+
+    Reads are spread round-robin over the replicas that passed the last health
+    check, falling back to the primary when none did. A client that wrote in the
+    last `pin_seconds` is pinned to the primary so it always reads its own writes.
+    The pin travels with the client as a wall-clock timestamp, so it holds
+    whichever worker serves the next read.
+    """
+
+    def __init__(self, primary, replicas=(), pin_seconds=5):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.pin_seconds = pin_seconds
+        self.healthy = list(self.replicas)
+        self.turn = 0
+
+    def pin_until(self):
+        """Timestamp handed to a client that just wrote, to send back with its reads."""
+        return time.time() + self.pin_seconds
+
+    def is_pinned(self, pinned_until):
+        return pinned_until > time.time()
+
+    def reader(self, pinned_until=0):
+        healthy = self.healthy
+        if not healthy or self.is_pinned(pinned_until):
+            return self.primary
+        self.turn = (self.turn + 1) % len(healthy)
+        return healthy[self.turn]
+
+    def check_health(self):
+        healthy = []
+        for replica in self.replicas:
+            try:
+                with replica.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+                healthy.append(replica)
+            except SQLAlchemyError:
+                pass
+        self.healthy = healthy
+
+    async def monitor(self, interval=5):
+        loop = asyncio.get_event_loop()
+        while True:
+            await loop.run_in_executor(None, self.check_health)
+            await asyncio.sleep(interval)
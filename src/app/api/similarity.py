@@ -0,0 +1,84 @@
+import heapq
+import math
+import threading
+from collections import Counter
+from operator import itemgetter
+
+
+class SimilarityIndex:
+    """Inverted index from course features to the courses that have them.
+
+    A course's features are its hashtags, students and favs. Similarity is the
+    cosine between binary feature vectors, computed by walking only the posting
+    lists of the course's own features. Features shared by more than
+    `max_posting` courses carry little signal and are skipped so a popular tag
+    cannot turn a lookup into a scan of the catalog.
+    """
+
+    def __init__(self, max_posting=5000):
+        self.max_posting = max_posting
+        self.features = {}
+        self.postings = {}
+        self.ready = False
+        self.replay = None
+        self.lock = threading.Lock()
+
+    def rebuild(self, load):
+        """Replace the index with the features returned by `load`, a full scan.
+
+        Updates that arrive while the scan runs may be missing from it, so they
+        are recorded and replayed on top of the new index before it is swapped in.
+        """
+        with self.lock:
+            self.replay = {}
+        try:
+            features = load()
+        except Exception:
+            with self.lock:
+                self.replay = None
+            raise
+        postings = {}
+        for courseId, course_features in features.items():
+            for feature in course_features:
+                postings.setdefault(feature, set()).add(courseId)
+        with self.lock:
+            self.features = {courseId: f for courseId, f in features.items() if f}
+            self.postings = postings
+            for courseId, course_features in self.replay.items():
+                self._update(courseId, course_features)
+            self.replay = None
+            self.ready = True
+
+    def update(self, courseId, features):
+        """Replace one course's features; an empty set removes the course."""
+        with self.lock:
+            if self.replay is not None:
+                self.replay[courseId] = features
+            self._update(courseId, features)
+
+    def _update(self, courseId, features):
+        old = self.features.pop(courseId, set())
+        for feature in old - features:
+            posting = self.postings[feature]
+            posting.discard(courseId)
+            if not posting:
+                del self.postings[feature]
+        for feature in features - old:
+            self.postings.setdefault(feature, set()).add(courseId)
+        if features:
+            self.features[courseId] = features
+
+    def similar(self, courseId, k):
+        with self.lock:
+            features = self.features.get(courseId)
+            if not features:
+                return []
+            overlap = Counter()
+            for feature in features:
+                posting = self.postings[feature]
+                if len(posting) <= self.max_posting:
+                    overlap.update(posting)
+            del overlap[courseId]
+            scores = ((other, shared / math.sqrt(len(features) * len(self.features[other])))
+                      for other, shared in overlap.items())
+            return heapq.nlargest(k, scores, key=itemgetter(1))
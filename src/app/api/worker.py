@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWorker:
+    """Runs derived-data jobs off the request path.
+
+    Jobs are (kind, key) pairs. A key already waiting in the queue is not queued
+    again, so a burst of writes to the same course is applied once, and each
+    batch is handed to the registered handler as a set of keys. When the worker
+    is not running, or its queue is full, the leftover jobs are applied
+    directly so no update is ever lost; called from the event loop, that work
+    goes to the default executor instead of blocking the loop.
+    """
+
+    def __init__(self, max_queue=1000, batch_size=200, linger=0.05):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.linger = linger
+        self.handlers = {}
+        self.queue = None
+        self.task = None
+        self.loop = None
+        self.pending = {}
+        self.counters = {'submitted': 0, 'coalesced': 0, 'processed': 0, 'failed': 0, 'batches': 0,
+                         'inline': 0}
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def submit(self, kind, *keys):
+        self.counters['submitted'] += len(keys)
+        overflow = set(keys)
+        if self.task is not None:
+            if self._on_loop():
+                overflow = self._enqueue(kind, keys)
+            else:
+                # asyncio.Queue is not thread-safe, so threadpool handlers enqueue through the loop.
+                overflow = asyncio.run_coroutine_threadsafe(self._enqueue_on_loop(kind, keys), self.loop).result()
+        if not overflow:
+            return
+        self.counters['inline'] += len(overflow)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._apply({kind: overflow})
+        else:
+            loop.run_in_executor(None, self._apply, {kind: overflow})
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(self.max_queue)
+        self.pending = {}
+        self.task = self.loop.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting queued jobs and drain the ones already pending."""
+        if self.task is None:
+            return
+        task, self.task = self.task, None
+        await self.queue.put(None)
+        await task
+
+    def status(self):
+        return {
+            'running': self.task is not None,
+            'depth': self.queue.qsize() if self.queue is not None else 0,
+            **self.counters
+        }
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _enqueue(self, kind, keys):
+        """Queue the keys not already waiting and return the ones that did not fit."""
+        pending = self.pending.setdefault(kind, set())
+        overflow = set()
+        for key in set(keys):
+            if key in pending:
+                self.counters['coalesced'] += 1
+                continue
+            try:
+                self.queue.put_nowait((kind, key))
+            except asyncio.QueueFull:
+                overflow.add(key)
+                continue
+            pending.add(key)
+        return overflow
+
+    async def _enqueue_on_loop(self, kind, keys):
+        return self._enqueue(kind, keys) if self.task is not None else set(keys)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        running = True
+        while running:
+            batch = [await self.queue.get()]
+            await asyncio.sleep(self.linger)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            running = None not in batch
+            jobs = {}
+            for item in batch:
+                if item is not None:
+                    kind, key = item
+                    # Taken off the queue, so a later write to this key queues it again.
+                    self.pending[kind].discard(key)
+                    jobs.setdefault(kind, set()).add(key)
+            if jobs:
+                await loop.run_in_executor(None, self._apply, jobs)
+
+    def _apply(self, jobs):
+        for kind, keys in jobs.items():
+            try:
+                self.handlers[kind](keys)
+                self.counters['processed'] += len(keys)
+            except Exception:
+                self.counters['failed'] += len(keys)
+                logger.exception('Background job %s failed for %d keys.', kind, len(keys))
+        self.counters['batches'] += 1
@@ -1,17 +1,33 @@
+import asyncio
+import logging
 import uvicorn
 import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from fastapi import FastAPI
+from fastapi import FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from starlette.responses import JSONResponse
 
-from app.db import engine, Base
+from app.db import engine, replica_engines, Base, POOL_SIZE
 from app.api import courses
+from app.api.invalidation import PostgresBus, SocketBus
 
 origins = ["*"]
-courses.set_engine(engine)
+REPLICA_HEALTH_INTERVAL = 5
+# Incremental updates reach every worker over the invalidation bus; the periodic rebuild
+# catches what a worker missed while its listener was down.
+SIMILARITY_REBUILD_INTERVAL = 600
+SIMILARITY_RETRY_INTERVAL = 30
+POOL_WARM_CONNECTIONS = int(os.environ.get('POOL_WARM_CONNECTIONS', POOL_SIZE))
+WARM_UP_RETRY_INTERVAL = 5
+# 'postgres' (LISTEN/NOTIFY), 'none', or a directory for the local socket bus.
+INVALIDATION_BUS = os.environ.get('INVALIDATION_BUS', 'postgres')
+
+courses.set_engine(engine, replica_engines)
 
 app = FastAPI()
+app.state.ready = False
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +39,102 @@ app.add_middleware(
 
 app.include_router(courses.router, prefix="/courses", tags=["courses"])
 
+
+@app.exception_handler(OperationalError)
+@app.exception_handler(PoolTimeoutError)
+async def database_busy(request, exc):
+    # Statement or pool timeouts: the request's session is already discarded, ask the client to back off.
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content='Database busy, retry later.', headers={'Retry-After': '1'})
+
+
+def warm_pool(bind, size):
+    # Asking for more than the pool can hand out would wait out pool_timeout and fail every retry.
+    if bind.pool._max_overflow >= 0:
+        size = min(size, bind.pool.size() + bind.pool._max_overflow)
+    # Hold all connections at once so the pool really opens `size` of them.
+    connections = [bind.connect() for _ in range(size)]
+    for connection in connections:
+        connection.close()
+
+
+def warm_up():
+    for bind in [engine] + replica_engines:
+        warm_pool(bind, POOL_WARM_CONNECTIONS)
+    courses.warm_up()
+
+
+async def warm_up_until_ready():
+    loop = asyncio.get_event_loop()
+    while not app.state.ready:
+        try:
+            await loop.run_in_executor(None, warm_up)
+            app.state.ready = True
+        except Exception:
+            logging.exception('Warm up failed, retrying.')
+            await asyncio.sleep(WARM_UP_RETRY_INTERVAL)
+
+
+def pool_status(bind):
+    return {
+        'size': bind.pool.size(),
+        'checkedin': bind.pool.checkedin(),
+        'checkedout': bind.pool.checkedout(),
+        'overflow': bind.pool.overflow()
+    }
+
+
+@app.get('/healthz')
+async def healthz():
+    return {'status': 'ok'}
+
+
+@app.get('/readyz')
+async def readyz():
+    report = {
+        'ready': app.state.ready,
+        'pool': pool_status(engine),
+        'replicas': {'total': len(replica_engines), 'healthy': len(courses.replicas.healthy)},
+        'tasks': courses.worker.status()['depth']
+    }
+    code = status.HTTP_200_OK if app.state.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return JSONResponse(status_code=code, content=report)
+
+
+async def rebuild_similarity():
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, courses.rebuild_similarity)
+        except Exception:
+            logging.exception('Similarity rebuild failed, retrying.')
+            await asyncio.sleep(SIMILARITY_RETRY_INTERVAL)
+            continue
+        await asyncio.sleep(SIMILARITY_REBUILD_INTERVAL)
+
+
+@app.on_event("startup")
+async def startup():
+    app.state.warm_up = asyncio.get_event_loop().create_task(warm_up_until_ready())
+    courses.worker.start()
+    if INVALIDATION_BUS == 'postgres':
+        courses.set_bus(PostgresBus(engine))
+    elif INVALIDATION_BUS != 'none':
+        courses.set_bus(SocketBus(INVALIDATION_BUS))
+    app.state.replica_monitor = asyncio.get_event_loop().create_task(
+        courses.replicas.monitor(REPLICA_HEALTH_INTERVAL))
+    app.state.similarity_rebuild = asyncio.get_event_loop().create_task(rebuild_similarity())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.warm_up.cancel()
+    app.state.replica_monitor.cancel()
+    app.state.similarity_rebuild.cancel()
+    await courses.worker.stop()
+    if courses.bus is not None:
+        courses.bus.stop()
+
 if __name__ == '__main__':
     Base.metadata.create_all(engine)
     uvicorn.run(app, host='0.0.0.0', port=8000)
@@ -0,0 +1,103 @@
+"""Per-request Python overhead of the get_courses filter builder.
+
+Compares the previous builder, which assembled a fresh ORM Query on every
+request, with the cached statements in courses.filter_courses. Both run against
+an in-memory SQLite copy of the schema, so the numbers are dominated by Python
+work rather than the database.
+
+    python src/benchmarks/course_filter.py
+"""
+import math
+import os
+import sys
+import timeit
+import uuid
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "app"))
+from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.compiler import compiles
+
+from api import courses
+from api.models import CourseFilter
+from db import Base, Course, Collaborator, Hashtag
+
+COURSES_PER_PAGE = courses.COURSES_PER_PAGE
+ROUNDS = 2000
+
+
+@compiles(UUID, 'sqlite')
+def _uuid_as_char(type_, compiler, **kw):
+    return 'CHAR(36)'
+
+
+def legacy_filter_courses(db, filter, page_num):
+    """The builder get_courses used before statements were cached."""
+    query = db.query(Course)
+    if filter.id is not None:
+        query = query.filter(Course.id == filter.id)
+    if filter.name is not None:
+        query = query.filter(Course.name.ilike(f'%{filter.name}%'))
+    if filter.owner is not None:
+        query = query.filter(Course.owner == filter.owner)
+    if filter.description is not None:
+        query = query.filter(
+            Course.description.ilike(f'%{filter.description}%'))
+    if filter.sub_level is not None:
+        query = query.filter(Course.sub_level == filter.sub_level)
+    if filter.latitude is not None:
+        query = query.filter(Course.latitude == filter.latitude)
+    if filter.longitude is not None:
+        query = query.filter(Course.longitude == filter.longitude)
+    if filter.student is not None:
+        query = query.filter(
+            Course.students.any(user_id=filter.student))
+    if filter.collaborator is not None:
+        query = query.join(Collaborator).filter((Collaborator.accepted == True) & (
+            Collaborator.user_id == filter.collaborator))
+    if filter.hashtags is not None:
+        for tag in filter.hashtags:
+            query = query.filter(
+                Course.hashtags.any(tag=tag))
+    if filter.minRating is not None:
+        query = query.filter(Course.rating >= filter.minRating)
+    if filter.category is not None:
+        query = query.filter(Course.category == filter.category)
+    if filter.faved_by is not None:
+        query = query.filter(Course.faved_by.any(user_id=filter.faved_by))
+    if filter.inEdition is not None:
+        query = query.filter(Course.in_edition == filter.inEdition)
+    if filter.blocked is not None:
+        query = query.filter(Course.blocked == filter.blocked)
+    num_pages = math.ceil(query.count()/COURSES_PER_PAGE)
+    query = query.limit(COURSES_PER_PAGE).offset((page_num-1)*COURSES_PER_PAGE)
+    return num_pages, query.all()
+
+
+def main():
+    engine = create_engine('sqlite://')
+    # SQLite cannot create the deferrable content constraints, and the filters never touch content.
+    Base.metadata.create_all(engine, tables=[table for table in Base.metadata.sorted_tables
+                                             if table.name != 'content'])
+    session = courses.set_engine(engine)
+    owner = uuid.uuid4()
+    tag = Hashtag(tag='python')
+    for i in range(50):
+        session.add(Course(name=f'course {i}', owner=owner, category='programming',
+                           hashtags=[tag] if i % 2 else []))
+    session.commit()
+
+    filters = {
+        'no filters': CourseFilter(hashtags=None),
+        'name + category': CourseFilter(name='course', category='programming', hashtags=None),
+        'owner + hashtags + minRating': CourseFilter(owner=owner, hashtags=['python'], minRating=0),
+    }
+    print(f'{"filters":32}{"before (us)":>14}{"after (us)":>14}')
+    for label, filter in filters.items():
+        assert legacy_filter_courses(session, filter, 1)[0] == courses.filter_courses(session, filter, 1)[0]
+        before = timeit.timeit(lambda: legacy_filter_courses(session, filter, 1), number=ROUNDS)
+        after = timeit.timeit(lambda: courses.filter_courses(session, filter, 1), number=ROUNDS)
+        print(f'{label:32}{before / ROUNDS * 1e6:>14.1f}{after / ROUNDS * 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
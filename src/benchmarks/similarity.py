@@ -0,0 +1,64 @@
+"""Lookup latency of the similar-courses index on a synthetic catalog.
+
+Builds a SimilarityIndex over COURSES courses whose hashtags follow a Zipf-like
+distribution and whose students and favs are drawn from a large user base,
+then times top-10 lookups for random courses. No database is involved.
+
+    python src/benchmarks/similarity.py [courses]
+"""
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from api.similarity import SimilarityIndex
+
+COURSES = 100000
+HASHTAGS = 2000
+USERS = 200000
+TAGS_PER_COURSE = 3
+STUDENTS_PER_COURSE = 8
+FAVS_PER_COURSE = 3
+LOOKUPS = 1000
+K = 10
+
+
+def synthetic_features(courses, rng):
+    tag_weights = [1 / rank for rank in range(1, HASHTAGS + 1)]
+    features = {}
+    for courseId in range(courses):
+        tags = rng.choices(range(HASHTAGS), tag_weights, k=TAGS_PER_COURSE)
+        features[courseId] = (
+            {('hashtag', tag) for tag in tags}
+            | {('student', rng.randrange(USERS)) for _ in range(STUDENTS_PER_COURSE)}
+            | {('fav', rng.randrange(USERS)) for _ in range(FAVS_PER_COURSE)})
+    return features
+
+
+def main():
+    courses = int(sys.argv[1]) if len(sys.argv) > 1 else COURSES
+    rng = random.Random(0)
+    features = synthetic_features(courses, rng)
+    index = SimilarityIndex()
+
+    start = time.perf_counter()
+    index.rebuild(lambda: features)
+    rebuild = time.perf_counter() - start
+
+    timings = []
+    for courseId in rng.sample(range(courses), LOOKUPS):
+        start = time.perf_counter()
+        index.similar(courseId, K)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    print(f'courses: {courses}, rebuild: {rebuild:.2f} s')
+    print(f'top-{K} lookup over {LOOKUPS} courses: '
+          f'mean {sum(timings) / LOOKUPS * 1e3:.2f} ms, '
+          f'p50 {timings[LOOKUPS // 2] * 1e3:.2f} ms, '
+          f'p99 {timings[LOOKUPS * 99 // 100] * 1e3:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,65 +1,113 @@
 import asyncio
+import contextvars
+import json
+import multiprocessing
+import threading
+import time
+import types
 import uuid
-from fastapi import status
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from fastapi import APIRouter, FastAPI, HTTPException, status
+from fastapi.testclient import TestClient
 from app.api import courses
-from app.api.models import CourseCreate, CourseUpdate, CourseFilter, Hashtags, ReviewCreate
+from app.api.admission import ConcurrencyLimiter
+from app.api.cache import CourseCache
+from app.api.invalidation import PostgresBus, SocketBus
+from app.api.replicas import ReplicaRouter
+from app.api.similarity import SimilarityIndex
+from app.api.worker import BackgroundWorker
+from sqlalchemy import create_engine, func
+from app.api.models import CourseCreate, CourseUpdate, CourseFilter, Hashtags, ReviewCreate, ContentCreate, ContentMove
 
 
 async def post(request: CourseCreate):
-    return await courses.create(request)
+    return courses.create(request)
 
 
 async def delete(courseId):
-    return await courses.delete(courses.check_course(courseId))
+    return courses.delete(courses.check_course(courseId))
 
 
 async def get(filter: CourseFilter, hashtags=[]):
     filter.hashtags = hashtags
-    return await courses.get_courses(page_num=1, filter=filter)
+    return courses.get_courses(page_num=1, filter=filter)
 
 
 async def update(courseId, request: CourseUpdate):
-    return await courses.update(request, courses.check_course(courseId))
+    return courses.update(request, courses.check_course(courseId))
 
 
 async def get_students(courseId):
-    return await courses.get_students(courses.check_course(courseId))
+    return courses.get_students(courses.check_course(courseId))
 
 
 async def add_student(courseId, userId):
-    return await courses.add_student(userId, courses.check_course(courseId))
+    return courses.add_student(userId, courses.check_course(courseId))
 
 
 async def get_collaborators(courseId):
-    return await courses.get_collaborators(courses.check_course(courseId))
+    return courses.get_collaborators(courses.check_course(courseId))
 
 
 async def get_pending_collaborations(userId):
-    return await courses.get_pending_collaborations(userId)
+    return courses.get_pending_collaborations(userId)
 
 
 async def add_collaborator(courseId, userId):
-    return await courses.add_collaborator(userId, courses.check_course(courseId))
+    return courses.add_collaborator(userId, courses.check_course(courseId))
 
 
 async def accept_collaborator(courseId, userId):
-    return await courses.accept_collaborator(userId, courses.check_course(courseId))
+    return courses.accept_collaborator(userId, courses.check_course(courseId))
 
 
 async def add_hashtags(courseId, tags):
-    return await courses.add_hashtags(Hashtags(tags=tags), courses.check_course(courseId))
+    return courses.add_hashtags(Hashtags(tags=tags), courses.check_course(courseId))
 
 
 async def add_review(request: ReviewCreate, courseId):
-    return await courses.add_review(request, courses.check_course(courseId))
+    return courses.add_review(request, courses.check_course(courseId))
 
 
 async def get_review(userId, courseId):
-    return await courses.get_review(userId, courses.check_course(courseId))
+    return courses.get_review(userId, courses.check_course(courseId))
+
+
+async def get_dashboard(userId):
+    return courses.get_dashboard(userId)
+
+
+async def get_similar(courseId, k=10):
+    return courses.get_similar(k, courses.check_course(courseId))
+
+
+async def add_content(courseId, name, link):
+    return courses.add_content(ContentCreate(name=name, link=link), courses.check_course(courseId))
+
+
+async def get_content_page(courseId, pagenum=1):
+    return courses.get_content_page(pagenum, courses.check_course(courseId))
+
+
+async def reorder_content(courseId, moves):
+    return courses.reorder_content([ContentMove(id=id, position=position) for id, position in moves],
+                                         courses.check_course(courseId))
+
+
+async def get_changes(after):
+    return await courses.get_changes(after, courses.CHANGES_BATCH, 0)
 
 
 async def get_all_reviews(courseId):
-    return await courses.get_all_reviews(1, courses.check_course(courseId))
+    return courses.get_all_reviews(1, courses.check_course(courseId))
+
+
+async def import_lines(lines, format='ndjson'):
+    async def stream():
+        for line in lines:
+            yield line
+    return await courses.import_lines(stream(), format)
 
 
 def test_post_and_get_by_id():
@@ -319,3 +367,435 @@ def test_add_and_get_all_reviews():
     assert {'userId': userId2, 'rating': 1,
             'description': ""} in reviews
     asyncio.run(delete(courseId))
+
+
+def test_import_ndjson_reports_invalid_lines():
+    ownerId = str(uuid.uuid4())
+    lines = [json.dumps({'name': 'test_import_ndjson', 'owner': ownerId, 'hashtags': ['importTag'],
+                         'content': [{'name': 'intro', 'link': 'http://intro'}],
+                         'collaborators': [str(uuid.uuid4())]}),
+             json.dumps({'name': 'test_import_ndjson_no_owner'}),
+             'not json']
+
+    result = asyncio.run(import_lines(lines))
+    course = asyncio.run(get(CourseFilter(id=result['courseIds'][0])))['content'][0]
+
+    assert result['created'] == 1
+    assert [error['line'] for error in result['errors']] == [2, 3]
+    assert course['hashtags'] == ['importTag']
+
+    asyncio.run(delete(result['courseIds'][0]))
+
+
+def test_import_reports_null_list_fields():
+    ownerId = str(uuid.uuid4())
+    lines = [json.dumps({'name': 'test_import_null_lists', 'owner': ownerId}),
+             json.dumps({'name': 'test_import_null_hashtags', 'owner': ownerId, 'hashtags': None})]
+
+    result = asyncio.run(import_lines(lines))
+
+    assert result['created'] == 1
+    assert [error['line'] for error in result['errors']] == [2]
+
+    asyncio.run(delete(result['courseIds'][0]))
+
+
+def test_import_rejects_invalid_utf8():
+    async def chunks():
+        yield b'{"name": "test_import_invalid_utf8", "owner": "\xff"}\n'
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(courses.import_lines(courses._stream_lines(chunks())))
+
+    assert e.value.status_code == 400
+    assert e.value.detail['created'] == 0
+
+
+def test_import_csv():
+    ownerId = str(uuid.uuid4())
+    lines = ['name,owner,hashtags,content',
+             f'test_import_csv,{ownerId},csvTag1;csvTag2,"[{{""name"": ""intro"", ""link"": ""http://intro""}}]"']
+
+    result = asyncio.run(import_lines(lines, 'csv'))
+    course = asyncio.run(get(CourseFilter(id=result['courseIds'][0])))['content'][0]
+
+    assert result['created'] == 1
+    assert sorted(course['hashtags']) == ['csvTag1', 'csvTag2']
+
+    asyncio.run(delete(result['courseIds'][0]))
+
+
+def test_delete_cascades_to_related_rows():
+    userId = uuid.uuid4()
+    courseId = asyncio.run(post(request=CourseCreate(
+        owner=userId, name='test_delete_cascades_to_related_rows', hashtags=['cascadeTag'])))["courseId"]
+    asyncio.run(add_student(courseId, userId))
+    asyncio.run(add_collaborator(courseId, userId))
+    asyncio.run(add_review(ReviewCreate(
+        description="", user_id=userId, rating=3), courseId))
+
+    asyncio.run(delete(courseId))
+
+    assert asyncio.run(get_pending_collaborations(userId)) == []
+    assert asyncio.run(get(CourseFilter(student=userId)))['content'] == []
+
+
+def test_get_dashboard():
+    userId = uuid.uuid4()
+    ownedId = asyncio.run(post(CourseCreate(owner=userId, name='test_get_dashboard_owned')))["courseId"]
+    enrolledId = asyncio.run(post(CourseCreate(owner=uuid.uuid4(), name='test_get_dashboard_enrolled')))["courseId"]
+    pendingId = asyncio.run(post(CourseCreate(owner=uuid.uuid4(), name='test_get_dashboard_pending')))["courseId"]
+    asyncio.run(add_student(enrolledId, userId))
+    asyncio.run(add_collaborator(pendingId, userId))
+
+    dashboard = asyncio.run(get_dashboard(userId))
+
+    assert [course['id'] for course in dashboard['owned']] == [ownedId]
+    assert [course['id'] for course in dashboard['enrolled']] == [enrolledId]
+    assert [course['id'] for course in dashboard['pending']] == [pendingId]
+    assert dashboard['collaborating'] == []
+    assert dashboard['favorites'] == []
+
+    asyncio.run(delete(ownedId))
+    asyncio.run(delete(enrolledId))
+    asyncio.run(delete(pendingId))
+
+
+def test_background_worker_updates_rating():
+    userId1 = uuid.uuid4()
+    userId2 = uuid.uuid4()
+    courseId = asyncio.run(post(request=CourseCreate(
+        owner=userId1, name='test_background_worker_updates_rating')))["courseId"]
+
+    async def review_in_background():
+        courses.worker.start()
+        await add_review(ReviewCreate(user_id=userId1, rating=3), courseId)
+        await add_review(ReviewCreate(user_id=userId2, rating=5), courseId)
+        await courses.worker.stop()
+
+    asyncio.run(review_in_background())
+    course = asyncio.run(get(CourseFilter(id=courseId)))['content'][0]
+
+    assert course['ratingAvg'] == 4
+    assert courses.worker.status()['depth'] == 0
+
+    asyncio.run(delete(courseId))
+
+
+def test_concurrency_limiter_rejects_when_saturated():
+    limiter = ConcurrencyLimiter(limit=1, max_waiting=0, timeout=0.1)
+
+    async def saturate():
+        admitted = await limiter.acquire()
+        rejected = not await limiter.acquire()
+        limiter.release()
+        return admitted, rejected, await limiter.acquire()
+
+    assert asyncio.run(saturate()) == (True, True, True)
+
+
+def test_router_rejects_saturated_routes_with_retry_after():
+    app = FastAPI()
+    app.include_router(courses.router, prefix='/courses')
+    courses.admission.limiters['get_task_metrics'] = ConcurrencyLimiter(limit=0, max_waiting=0, timeout=0.1)
+    try:
+        response = TestClient(app).get('/courses/tasks/metrics')
+    finally:
+        del courses.admission.limiters['get_task_metrics']
+
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_admission_keeps_slots_for_cheap_routes():
+    def request(endpoint):
+        return types.SimpleNamespace(scope={'endpoint': endpoint})
+
+    async def admit(endpoint):
+        admitted = courses.admission(request(endpoint))
+        await asyncio.wait_for(admitted.__anext__(), 0.5)
+        return admitted
+
+    async def saturate():
+        heavy = [await admit(courses.get_courses) for _ in range(courses.HEAVY_SLOTS)]
+        cheap = await admit(courses.get_owner)
+        for admitted in heavy + [cheap]:
+            await admitted.aclose()
+
+    asyncio.run(saturate())
+
+    assert courses.HEAVY_SLOTS < courses.POOL_SIZE
+
+
+def test_background_worker_accepts_jobs_from_threads():
+    worker = BackgroundWorker(linger=0)
+    applied = []
+    worker.register('job', applied.extend)
+
+    async def submit_from_thread():
+        worker.start()
+        await asyncio.get_event_loop().run_in_executor(None, worker.submit, 'job', 1, 2)
+        await worker.stop()
+
+    asyncio.run(submit_from_thread())
+
+    assert sorted(applied) == [1, 2]
+    assert worker.status()['inline'] == 0
+
+
+def test_background_worker_keeps_overflow_off_the_loop():
+    worker = BackgroundWorker(max_queue=3, linger=0)
+    applied = []
+    worker.register('job', lambda keys: applied.append((set(keys), threading.current_thread())))
+
+    async def flood():
+        worker.start()
+        worker.submit('job', *range(10))
+        worker.submit('job', 0, 1)
+        await worker.stop()
+
+    asyncio.run(flood())
+
+    assert set().union(*[keys for keys, _ in applied]) == set(range(10))
+    assert threading.main_thread() not in [thread for _, thread in applied]
+    assert worker.status()['coalesced'] == 2
+
+
+def test_replica_router_pins_writers_to_primary():
+    primary = create_engine('sqlite://')
+    replica1 = create_engine('sqlite://')
+    replica2 = create_engine('sqlite://')
+    router = ReplicaRouter(primary, [replica1, replica2])
+
+    reads = {router.reader(), router.reader()}
+    pinned_until = router.pin_until()
+
+    assert reads == {replica1, replica2}
+    assert router.reader(pinned_until) is primary
+    assert router.reader(time.time() - 1) in (replica1, replica2)
+
+    router.check_health()
+    assert router.healthy == [replica1, replica2]
+
+
+def test_course_summary_cache_respects_replicas_and_pins():
+    course = types.SimpleNamespace(
+        id=uuid.uuid4(), name='test_course_summary_cache', description='', owner=uuid.uuid4(), sub_level=0,
+        category=None, latitude=None, longitude=None, hashtags=[], time_created=None, blocked=False,
+        in_edition=False, reviews=[], rating=0)
+    key = str(course.id)
+
+    def from_replica():
+        courses._read_session.set(object())
+        return courses._course_summary(course)
+
+    def while_pinned():
+        courses._pinned.set(True)
+        return courses._course_summary(course)
+
+    contextvars.copy_context().run(from_replica)
+    assert courses.cache.get(key) is None
+
+    courses.cache.set(key, {'id': key, 'name': 'stale'})
+    assert contextvars.copy_context().run(while_pinned)['name'] == 'test_course_summary_cache'
+
+    courses.cache.evict([key])
+
+
+def test_writes_pin_the_client_to_the_primary():
+    app = FastAPI()
+    router = APIRouter(route_class=courses.PinningRoute)
+    router.add_api_route('/write', lambda: {}, methods=['POST'])
+    router.add_api_route('/read', lambda: {}, methods=['GET'])
+    app.include_router(router)
+    client = TestClient(app)
+
+    write = client.post('/write')
+    read = client.get('/read')
+
+    assert float(write.headers[courses.PIN_HEADER]) > time.time()
+    assert write.cookies[courses.PIN_COOKIE] == write.headers[courses.PIN_HEADER]
+    assert courses.PIN_HEADER not in read.headers
+
+
+def cache_process(directory, courseId, ready, evicted):
+    cache = CourseCache()
+    cache.set(courseId, {'id': courseId})
+    bus = SocketBus(directory)
+    bus.start(lambda kind, ids: cache.evict(ids), cache.clear)
+    ready.put(True)
+    deadline = time.monotonic() + 5
+    while cache.get(courseId) is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    evicted.put(cache.get(courseId) is None)
+    bus.stop()
+
+
+def test_socket_bus_evicts_in_every_process(tmp_path):
+    courseId = str(uuid.uuid4())
+    ready = multiprocessing.Queue()
+    evicted = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=cache_process, args=(str(tmp_path), courseId, ready, evicted))
+                 for _ in range(3)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get(timeout=5)
+
+    SocketBus(str(tmp_path)).publish([courseId])
+
+    assert [evicted.get(timeout=10) for _ in processes] == [True, True, True]
+    for process in processes:
+        process.join()
+
+
+def test_socket_bus_carries_message_kinds(tmp_path):
+    received = multiprocessing.Queue()
+    bus = SocketBus(str(tmp_path))
+    bus.start(lambda kind, ids: received.put((kind, ids)))
+    courseId = str(uuid.uuid4())
+
+    bus.publish([courseId], kind='similarity')
+
+    assert received.get(timeout=5) == ('similarity', [courseId])
+    bus.stop()
+
+
+def test_postgres_bus_starts_while_database_is_down():
+    bus = PostgresBus(create_engine('postgresql://nobody@127.0.0.1:1/nothing'))
+    bus.start(lambda kind, ids: None, lambda: None)
+
+    assert bus.thread.is_alive()
+
+    bus.stop()
+    assert not bus.thread.is_alive()
+
+
+def test_stream_changes_rejects_malformed_last_event_id():
+    app = FastAPI()
+    app.include_router(courses.router, prefix='/courses')
+
+    response = TestClient(app).get('/courses/changes/stream', headers={'Last-Event-ID': 'abc'})
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_get_by_collaborator_and_owner():
+    ownerId = uuid.uuid4()
+    userId = uuid.uuid4()
+    courseId = asyncio.run(
+        post(CourseCreate(owner=ownerId, name='test_get_by_collaborator_and_owner')))["courseId"]
+    asyncio.run(add_collaborator(courseId, userId))
+
+    pending = asyncio.run(get(CourseFilter(collaborator=userId, owner=ownerId)))['content']
+    asyncio.run(accept_collaborator(courseId, userId))
+    accepted = asyncio.run(get(CourseFilter(collaborator=userId, owner=ownerId)))['content']
+
+    assert pending == []
+    assert [course['id'] for course in accepted] == [courseId]
+
+    asyncio.run(delete(courseId))
+
+
+def test_get_similar_by_shared_hashtags():
+    ownerId = uuid.uuid4()
+    tag1, tag2, tag3 = [str(uuid.uuid4()) for _ in range(3)]
+    courseId1 = asyncio.run(post(CourseCreate(owner=ownerId, name='test_similar1', hashtags=[tag1, tag2])))["courseId"]
+    courseId2 = asyncio.run(post(CourseCreate(owner=ownerId, name='test_similar2', hashtags=[tag1, tag2])))["courseId"]
+    courseId3 = asyncio.run(post(CourseCreate(owner=ownerId, name='test_similar3', hashtags=[tag1, tag3])))["courseId"]
+    courseId4 = asyncio.run(post(CourseCreate(owner=ownerId, name='test_similar4', hashtags=[tag3])))["courseId"]
+    courses.rebuild_similarity()
+
+    similar = asyncio.run(get_similar(courseId1))
+
+    assert [course['id'] for course in similar] == [courseId2, courseId3]
+    assert similar[0]['score'] == 1
+
+    asyncio.run(delete(courseId2))
+    assert [course['id'] for course in asyncio.run(get_similar(courseId1))] == [courseId3]
+
+    asyncio.run(delete(courseId1))
+    asyncio.run(delete(courseId3))
+    asyncio.run(delete(courseId4))
+
+
+def test_similarity_rebuild_keeps_updates_made_during_the_scan():
+    index = SimilarityIndex()
+    index.update('course1', {'tag1'})
+
+    def scan():
+        # The scan started before course2 was written, so it does not include it.
+        index.update('course2', {'tag1'})
+        return {'course1': {'tag1'}}
+
+    index.rebuild(scan)
+
+    assert index.similar('course1', 10) == [('course2', 1.0)]
+
+
+def test_get_similar_waits_for_the_first_build():
+    courses.similarity.ready, ready = False, courses.similarity.ready
+    try:
+        with pytest.raises(HTTPException) as e:
+            courses.get_similar(10, None)
+    finally:
+        courses.similarity.ready = ready
+
+    assert e.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert e.value.headers['Retry-After'] == str(courses.SIMILARITY_RETRY_AFTER)
+
+
+def test_add_and_reorder_content():
+    courseId = asyncio.run(post(CourseCreate(owner=uuid.uuid4(), name='test_add_and_reorder_content')))["courseId"]
+    asyncio.run(add_content(courseId, 'first', 'http://first'))
+    asyncio.run(add_content(courseId, 'second', 'http://second'))
+    duplicate = asyncio.run(add_content(courseId, 'first', 'http://other'))
+
+    first, second = asyncio.run(get_content_page(courseId))['content']
+    reorder = asyncio.run(reorder_content(courseId, [(first['id'], second['position']),
+                                                     (second['id'], first['position'])]))
+    content = asyncio.run(get_content_page(courseId))['content']
+
+    assert duplicate.status_code == status.HTTP_409_CONFLICT
+    assert reorder.status_code == status.HTTP_202_ACCEPTED
+    assert [item['name'] for item in content] == ['second', 'first']
+
+    asyncio.run(delete(courseId))
+
+
+def test_concurrent_content_appends_get_distinct_positions():
+    courseId = asyncio.run(post(CourseCreate(
+        owner=uuid.uuid4(), name='test_concurrent_content_appends')))["courseId"]
+    names = ['first', 'second', 'third', 'fourth']
+
+    def append(name):
+        # Each append gets its own session, like concurrent requests do.
+        courses._request_scope.set(object())
+        try:
+            return courses.add_content(ContentCreate(name=name, link=f'http://{name}'),
+                                       courses.check_course(courseId)).status_code
+        finally:
+            courses.session.remove()
+
+    with ThreadPoolExecutor(len(names)) as pool:
+        codes = list(pool.map(lambda name: contextvars.copy_context().run(append, name), names))
+    content = asyncio.run(get_content_page(courseId))['content']
+
+    assert codes == [status.HTTP_201_CREATED] * len(names)
+    assert [item['position'] for item in content] == [1, 2, 3, 4]
+
+    asyncio.run(delete(courseId))
+
+
+def test_change_feed_records_mutations():
+    after = courses.session.query(func.max(courses.CourseChange.seq)).scalar() or 0
+    courseId = asyncio.run(post(CourseCreate(owner=uuid.uuid4(), name='test_change_feed_records_mutations')))["courseId"]
+    courses.set_block(True, courses.check_course(courseId))
+    asyncio.run(delete(courseId))
+
+    feed = asyncio.run(get_changes(after))
+    changes = [(change['courseId'], change['kind']) for change in feed['changes']]
+
+    assert changes == [(courseId, 'created'), (courseId, 'blocked'), (courseId, 'deleted')]
+    assert feed['cursor'] == feed['changes'][-1]['seq']
+    assert asyncio.run(get_changes(feed['cursor']))['changes'] == []